@@ -13,27 +13,62 @@ from datetime import datetime
 from datetime import timedelta
 from datetime import date
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 import time
 import calendar
 import httplib2
 import csv
+import io
 import sys
 import re
 import os
-import copy
+import operator
+import itertools
+import threading
 import argparse
 import configparser
 import pprint
+import functools
 
 LOCAL_DIR   = os.path.dirname(os.path.realpath(__file__))
 CONFIG_FILE = "download.cfg"
 
-# Maximum number of dimensions "batches" (can be increased if neeeded)
-MAX_DIM_BATCHES = 20
+# Required options of the common configuration section
+COMMON_OPTIONS = [ 'SCOPES', 'DISCOVERY_URI', 'KEY_FILE_LOCATION', 'SERVICE_ACCOUNT_EMAIL',
+                   'MAX_RESULTS', 'INVALID_VALUE', 'VIEW_ID' ]
+
+# Buffer size for the CSV output (file or non-interactive standard output)
+OUTPUT_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Maximum number of report requests in a single batch call (Reporting API v4 limit)
+MAX_REPORT_REQUESTS = 5
+
+# Partial response with only the report elements that are used (the metric values are never used)
+REPORT_FIELDS = 'reports(columnHeader/dimensions,data/rows/dimensions,nextPageToken)'
+
+# Default maximum number of batch calls running at the same time (Google Analytics limit per view)
+MAX_CONCURRENT_REQUESTS = 10
+
+# Timeout in seconds for each request on the (persistent) HTTP connection
+HTTP_TIMEOUT = 60
 
 # Operators for search
 GA_SEARCH_OPS = [ 'REGEXP', 'BEGINS_WITH', 'ENDS_WITH', 'PARTIAL', 'EXACT' ]
 
+# Compiled patterns for the dates (YYYY-MM-DD or relative) and each filter clause, with
+# its preceding operator (AND/OR), matching up to the next operator or the end
+DATE_RE      = re.compile(r'^(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})$')
+REL_DATE_RE  = re.compile(r'^(?P<relative>today|yesterday|(?P<days>[0-9]+)daysAgo)$')
+CLAUSE_RE    = re.compile(r' *(?:(?P<connector>AND|OR) +)?(?P<dimension>ga:\w+) +(?P<operator>%s) '
+                          r'(?P<expression>.*?) *(?= (?:AND|OR) |$)' % '|'.join(GA_SEARCH_OPS))
+
+# Sections of the dimensions "batches", numbered in the order of the batches
+BATCH_SECTION_RE = re.compile(r'^batch-dimensions-(?P<number>[0-9]+)$')
+
+# Non-ascii characters, removed from the downloaded values
+NON_ASCII_RE = re.compile(r'[^\x00-\x7f]')
+
 PROG_DESC = """Download results from Google Analytics.  
 
 The date format is YYYY-MM-DD or relative date (e.g. today, yesterday, NdaysAgo where N is 
@@ -72,6 +107,24 @@ def getPprint ():
         getPprint.pp = pprint.PrettyPrinter(indent=2)
     return getPprint.pp
 
+def getFileno (fpFile):
+    """Get the file descriptor of a file object, or None if it is not backed by one"""
+    try:
+        return fpFile.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+@functools.lru_cache(maxsize=65536)
+def getAsciiValue (sValue):
+    """Get the value without the non-ascii characters, cached as the values often repeat"""
+    return NON_ASCII_RE.sub('', sValue)
+
+def getStitchElements (aRows, iStitch):
+    """Get a dictionary of the rows after the header without the leading stitch elements,
+       keyed by those stitch elements (a tuple of the values, or the single value)"""
+    fKey = operator.itemgetter(*range(iStitch))
+    return { fKey(aRow): aRow[iStitch:] for aRow in itertools.islice(aRows, 1, None) }
+
 def getArgParser ():
     """Management of the command-line argument parser"""
     oParser = argparse.ArgumentParser(description=PROG_DESC, formatter_class=argparse.RawTextHelpFormatter)
@@ -100,6 +153,17 @@ def getArgParser ():
     return oParser
 
 class Download:
+    def __init__ (self):
+        # Analytics service shared by all threads, built only once
+        self.oAnalytics     = None
+        self.oAnalyticsLock = threading.Lock()
+
+        # HTTP object for each thread, as the HTTP connection is not thread-safe
+        self.oThreadData    = threading.local()
+
+        # Set when the batch downloads must stop, checked by each batch between its pages
+        self.oStopEvent     = threading.Event()
+
     def main (self):
         """Primary class method"""
         self.getCmdOptions()
@@ -107,14 +171,11 @@ class Download:
         
         # Get the users and the results, depending on the options
         if self.oCmdOptions.bUsers:
-            aUsers   = self.processReport(self.USER_DIMENSIONS)
-            self.outputRows(aUsers)
+            self.outputRows(self.iterReport(self.USER_DIMENSIONS))
         elif self.oCmdOptions.bResults:
-            aResults = self.processReport(self.RESULTS_DIMENSIONS)
-            self.outputRows(aResults)
+            self.outputRows(self.iterReport(self.RESULTS_DIMENSIONS))
         elif self.oCmdOptions.bValidate:
-            aUsers   = self.processReport(self.USER_DIMENSIONS)
-            aResults = self.processReport(self.RESULTS_DIMENSIONS)
+            aUsers, aResults = self.processReports([ self.USER_DIMENSIONS, self.RESULTS_DIMENSIONS ])
             print("Total number of users: %d" % (len(aUsers) - 1))
             print("Total number of results: %d" % (len(aResults) - 1))
         else:
@@ -122,16 +183,42 @@ class Download:
     
     def getConfig (self):
         """Get all configuration elements"""
-        self.oConfig = configparser.RawConfigParser()
-        self.oConfig.read(LOCAL_DIR + "/" +  CONFIG_FILE)
-
-        self.SCOPES                = self.getConfigValue('common', 'SCOPES')
-        self.DISCOVERY_URI         = self.getConfigValue('common', 'DISCOVERY_URI')
-        self.KEY_FILE_LOCATION     = self.getConfigValue('common', 'KEY_FILE_LOCATION')
-        self.SERVICE_ACCOUNT_EMAIL = self.getConfigValue('common', 'SERVICE_ACCOUNT_EMAIL')
-        self.MAX_RESULTS           = self.getConfigValue('common', 'MAX_RESULTS')
-        self.INVALID_VALUE         = self.getConfigValue('common', 'INVALID_VALUE')
-        self.VIEW_ID               = self.getConfigValue('common', 'VIEW_ID')
+        oConfig = configparser.RawConfigParser()
+        oConfig.read(LOCAL_DIR + "/" +  CONFIG_FILE)
+
+        # Parse each section only once into a plain dictionary, used for all the configuration elements
+        self.dConfig = { sSection: dict(oConfig.items(sSection, raw=True)) for sSection in oConfig.sections() }
+
+        # Read the common section only once, checking for all missing options (the keys are lower case)
+        dCommon  = self.getConfigSectionDict('common')
+        aMissing = [ sKey for sKey in COMMON_OPTIONS if sKey.lower() not in dCommon ]
+        if aMissing:
+            errorMsg("Missing configuration options: " + ', '.join('common:' + sKey for sKey in aMissing))
+
+        self.SCOPES                = dCommon['scopes']
+        self.DISCOVERY_URI         = dCommon['discovery_uri']
+        self.KEY_FILE_LOCATION     = dCommon['key_file_location']
+        self.SERVICE_ACCOUNT_EMAIL = dCommon['service_account_email']
+        self.MAX_RESULTS           = dCommon['max_results']
+        self.INVALID_VALUE         = dCommon['invalid_value']
+        self.VIEW_ID               = dCommon['view_id']
+
+        # Maximum results is sent with every request as a number
+        try:
+            self.MAX_RESULTS = int(self.MAX_RESULTS)
+        except ValueError:
+            errorMsg("Invalid configuration option: common:MAX_RESULTS = " + self.MAX_RESULTS)
+
+        # Optional limit of concurrent requests, lowered if sharing the quota with other downloads
+        self.MAX_CONCURRENT_REQUESTS = MAX_CONCURRENT_REQUESTS
+        sMaxConcurrent = dCommon.get('max_concurrent_requests')
+        if sMaxConcurrent != None:
+            try:
+                self.MAX_CONCURRENT_REQUESTS = int(sMaxConcurrent)
+            except ValueError:
+                errorMsg("Invalid configuration option: common:MAX_CONCURRENT_REQUESTS = " + sMaxConcurrent)
+            if self.MAX_CONCURRENT_REQUESTS < 1:
+                errorMsg("Invalid configuration option: common:MAX_CONCURRENT_REQUESTS = " + sMaxConcurrent)
         
         self.CUSTOM_DIMENSIONS     = self.getConfigDimensionDict('custom-dimensions')
         self.STITCH_DIMENSIONS     = self.getConfigDimensions('stitch-dimensions')
@@ -141,21 +228,25 @@ class Download:
         # First dimension of users and results must be equal
         if self.USER_DIMENSIONS[0] != self.RESULTS_DIMENSIONS[0]:
             errorMsg("First dimension of user and result groups must be equal")
-        
-        # Get each batch of dimensions as a separate array
-        self.BATCH_DIMENSIONS = []
-        for iSection in range(1, MAX_DIM_BATCHES):
-            sSection = 'batch-dimensions-%d' % iSection
-            if self.oConfig.has_section(sSection):
-                self.BATCH_DIMENSIONS.append(self.getConfigDimensions(sSection))
-
-        # Common batch parameters
-        self.BATCH_PARAMS = {
-            'reportRequests': [{
-                'pageSize': self.MAX_RESULTS,
-                'metrics':[{ 'expression': 'ga:users' }],
-            }]
-        }
+
+        # Get each batch of dimensions as a separate array, in the order of the section numbers
+        aBatchSections = []
+        for sSection in self.dConfig:
+            oMatch = BATCH_SECTION_RE.match(sSection)
+            if oMatch:
+                aBatchSections.append((int(oMatch.group('number')), sSection))
+        self.BATCH_DIMENSIONS = [ self.getConfigDimensions(sSection) for iNumber, sSection in sorted(aBatchSections) ]
+
+        # Batches can only be combined with the results using at least one stitch dimension
+        if self.BATCH_DIMENSIONS and not self.STITCH_DIMENSIONS:
+            errorMsg("Stitch dimensions are required with batch dimensions: section stitch-dimensions is empty")
+
+        # Stitch dimensions must all be found in the results to combine them with the batches
+        if self.BATCH_DIMENSIONS:
+            aMissing = [ dStitchDim['name'] for dStitchDim in self.STITCH_DIMENSIONS
+                         if dStitchDim not in self.RESULTS_DIMENSIONS ]
+            if aMissing:
+                errorMsg("Stitch dimensions missing from the results dimensions: " + ', '.join(aMissing))
                 
 
     def getCmdOptions (self):
@@ -183,17 +274,8 @@ class Download:
         elif not self.validDate(self.oCmdOptions.sEndDate):
             usage('invalid end date format: "%s"' % (self.oCmdOptions.sEndDate))
 
-    def getConfigValue (self, sSection, sKey, bRequired = True):
-        """Get a configuration value"""
-        sValue = None
-        if self.oConfig.has_section(sSection):
-            if self.oConfig.has_option(sSection, sKey):
-               sValue =  self.oConfig[sSection][sKey]
-            elif bRequired:
-                errorMsg("Missing configuration option: %s:%s" % (sSection, sKey))
-        elif bRequired:
-            errorMsg("Missing configuration section: " + sSection)
-        return sValue
+        # Parse any dimension filters only once, checking for errors immediately
+        self.aDimFilters = self.parseDimensionFilters()
 
     def getConfigDimensions (self, sSection, bRequired = True):
         """Get a set of configuration dimensions"""
@@ -203,9 +285,8 @@ class Download:
     def getConfigSectionArray (self, sSection, bRequired = True):
         """Get a configuration section as an array, ignoring the option keys"""
         aSectionConfig = []
-        if self.oConfig.has_section(sSection):
-            for sKey, sValue in self.oConfig.items(sSection):
-                aSectionConfig.append(sValue)
+        if sSection in self.dConfig:
+            aSectionConfig = list(self.dConfig[sSection].values())
         elif bRequired:
             errorMsg("Missing configuration section: " + sSection)
         return aSectionConfig
@@ -218,298 +299,374 @@ class Download:
     def getConfigSectionDict (self, sSection, bRequired = True):
         """Get a configuration section as a dictionary"""
         dSectionConfig = {}
-        if self.oConfig.has_section(sSection):
-            dSectionConfig = self.oConfig[sSection]
+        if sSection in self.dConfig:
+            dSectionConfig = self.dConfig[sSection]
         elif bRequired:
             errorMsg("Missing configuration section: " + sSection)
         return dSectionConfig
 
     def getAnalytics (self):
-        """Initializes an analyticsreporting service object"""
-        if hasattr(self, 'oAnalytics'):
-            return self.oAnalytics
-        try: 
-            oCredentials = ServiceAccountCredentials.from_p12_keyfile(self.SERVICE_ACCOUNT_EMAIL,
-                                                                      self.KEY_FILE_LOCATION,
-                                                                      scopes=self.SCOPES)
-            oHttp = oCredentials.authorize(httplib2.Http())
-            self.oAnalytics = build('analytics', 'v4', http=oHttp, discoveryServiceUrl=self.DISCOVERY_URI)
-            return self.oAnalytics
-        except BaseException as e:
-            errorMsg("Unable to build Google Analytics authorization: " + str(e))
+        """Initializes the analyticsreporting service object, shared by all threads"""
+        if self.oAnalytics == None:
+            with self.oAnalyticsLock:
+                if self.oAnalytics == None:
+                    try: 
+                        self.oCredentials = ServiceAccountCredentials.from_p12_keyfile(self.SERVICE_ACCOUNT_EMAIL,
+                                                                                       self.KEY_FILE_LOCATION,
+                                                                                       scopes=self.SCOPES)
+                        self.oAnalytics = build('analytics', 'v4', http=self.getHttp(),
+                                                discoveryServiceUrl=self.DISCOVERY_URI, cache_discovery=False)
+                    except BaseException as e:
+                        errorMsg("Unable to build Google Analytics authorization: " + str(e))
+        return self.oAnalytics
+
+    def getHttp (self):
+        """Get the authorized HTTP object for the current thread, keeping its connection open across all pages"""
+        if not hasattr(self.oThreadData, 'oHttp'):
+            self.oThreadData.oHttp = self.oCredentials.authorize(httplib2.Http(timeout=HTTP_TIMEOUT))
+        return self.oThreadData.oHttp
             
 
     def getDimensionFilters (self):
-        """Get optional dimension filters"""
+        """Get optional dimension filters, as parsed from the command line options"""
+        return self.aDimFilters
+
+    def parseDimensionFilters (self):
+        """Parse the optional dimension filters"""
 
         if self.oCmdOptions.sFilter == None:
             return None
 
-        # Filters follow the format shown above in program description
-        reFilter = re.compile(' *(ga:\w+) +(%s) (.*)' % '|'.join(GA_SEARCH_OPS))
-        
-        # Break apart each filter
-        aFilters = []
-        sFilter  = self.oCmdOptions.sFilter
-        if re.search(r' AND ', sFilter):
-            sOperator = 'AND'
-            aSplit    = sFilter.split(' AND ')
-        elif re.search(r' OR ', sFilter):
-            sOperator = 'OR'
-            aSplit    = sFilter.split(' OR ')
-        else:
-            sOperator = None
-            aSplit    = [ sFilter ]
-
-        for sFilter in aSplit:
-            oMatch = reFilter.match(sFilter)
-            if oMatch == None:
-                errorMsg("Invalid filter arguments: " + self.oCmdOptions.sFilter)
+        # Break apart each filter in a single pass, following the format shown above in program description
+        aFilters   = []
+        aOperators = set()
+        sFilter    = self.oCmdOptions.sFilter
+        iPos       = 0
+        while iPos < len(sFilter):
+            oMatch = CLAUSE_RE.match(sFilter, iPos)
+
+            # Each filter after the first must follow an operator
+            if oMatch == None or (oMatch.group('connector') == None) != (iPos == 0):
+                errorMsg("Invalid filter arguments: " + sFilter)
+            if oMatch.group('connector') != None:
+                aOperators.add(oMatch.group('connector'))
             aFilters.append({
-                'dimensionName': oMatch.group(1),
-                'operator':      oMatch.group(2),
-                'expressions':   [ oMatch.group(3).strip() ]
+                'dimensionName': oMatch.group('dimension'),
+                'operator':      oMatch.group('operator'),
+                'expressions':   [ oMatch.group('expression').strip() ]
             })
+            iPos = oMatch.end()
+
+        # At least one filter is required, and the operators cannot be mixed
+        if len(aFilters) == 0 or len(aOperators) > 1:
+            errorMsg("Invalid filter arguments: " + sFilter)
+        sOperator = aOperators.pop() if aOperators else None
 
         return { "operator": sOperator, "filters": aFilters }
             
-    def getReport (self, aDimensions, sPageToken = None):
-        """Get the report with certain dimensions and starting element"""
+    def getReport (self, aDimensionsList, aPageTokens = None):
+        """Get the reports with certain dimensions and starting elements in a single batch call"""
 
-        # Get any dimension filters, checking for errors immediately
+        # Get any dimension filters
         aDimFilters = self.getDimensionFilters()
 
         # Get the analytics connection
         oAnalytics = self.getAnalytics()
 
-        # Add the dimensions and date range (from the command line options)
-        aBatchParams = copy.deepcopy(self.BATCH_PARAMS)
-        aBatchParams['reportRequests'][0]['viewId']     = self.VIEW_ID
-        aBatchParams['reportRequests'][0]['dimensions'] = aDimensions
-        aBatchParams['reportRequests'][0]['dateRanges'] = [ { 'startDate': self.oCmdOptions.sStartDate,
-                                                              'endDate': self.oCmdOptions.sEndDate } ]
-        if aDimFilters:
-            aBatchParams['reportRequests'][0]['dimensionFilterClauses'] = [ aDimFilters ]
-
-        if sPageToken != None:
-            aBatchParams['reportRequests'][0]['pageToken'] = sPageToken
-        else:
-            aBatchParams['reportRequests'][0].pop('pageToken', None)
+        # Without page tokens, start each report at the first element
+        if aPageTokens == None:
+            aPageTokens = [ None ] * len(aDimensionsList)
+
+        # Add a report request for each set of dimensions with the date range (from the command line options)
+        aReportRequests = []
+        for aDimensions, sPageToken in zip(aDimensionsList, aPageTokens):
+            aRequest = {
+                'viewId':     self.VIEW_ID,
+                'pageSize':   self.MAX_RESULTS,
+                'metrics':    [ { 'expression': 'ga:users' } ],
+                'dimensions': aDimensions,
+                'dateRanges': [ { 'startDate': self.oCmdOptions.sStartDate,
+                                  'endDate': self.oCmdOptions.sEndDate } ]
+            }
+            if aDimFilters:
+                aRequest['dimensionFilterClauses'] = [ aDimFilters ]
+            if sPageToken != None:
+                aRequest['pageToken'] = sPageToken
+            aReportRequests.append(aRequest)
+        aBatchParams = { 'reportRequests': aReportRequests }
 
         if self.oCmdOptions.bDebugMode:
             print("getReport - batch params: ")
             getPprint().pprint(aBatchParams)
-        return oAnalytics.reports().batchGet(body=aBatchParams).execute()
+        return oAnalytics.reports().batchGet(body=aBatchParams, fields=REPORT_FIELDS).execute(http=self.getHttp())
 
     def getResponse (self, oResponse, bHeader):
-        """Gets all the rows from the response"""
+        """Gets all the rows from each report in the response, in the order of the report requests"""
 
-        sNextPageToken = None
-        aAllRows = []
-        for oReport in oResponse.get('reports', []):
+        aReports = []
+        for iReport, oReport in enumerate(oResponse.get('reports', [])):
             oColumnHeader     = oReport.get('columnHeader', {})
             sNextPageToken    = oReport.get('nextPageToken', None)
             aDimensionHeaders = oColumnHeader.get('dimensions', [])
             aRows             = oReport.get('data', {}).get('rows', [])
+            aAllRows          = []
 
             # Create the header row
             if bHeader == True:
                 aAllRows.append(aDimensionHeaders)
 
-            # Save all the rows, removing the non-ascii characters
+            # Save all the rows, removing the non-ascii characters (using local names in the loop)
+            fAppend = aAllRows.append
+            fAscii  = getAsciiValue
             for oRow in aRows:
-                aDimensions = oRow.get('dimensions', [])
-                for i in range(0, len(aDimensions)):
-                    aDimensions[i] = aDimensions[i].encode('ascii', 'ignore').decode('ascii')
-                aAllRows.append(aDimensions)
-                
-        if self.oCmdOptions.bDebugMode:
-            if sNextPageToken:
-                print("Response: number of rows %d with next token %s" % (len(aAllRows) - 1, sNextPageToken))
-            else:
-                print("Response: number of rows %d (no next page)" % (len(aAllRows) - 1))
-                
-        return { 'rows': aAllRows, 'nextPageToken': sNextPageToken }
+                fAppend([ sValue if sValue.isascii() else fAscii(sValue) for sValue in oRow.get('dimensions', []) ])
+
+            if self.oCmdOptions.bDebugMode:
+                if sNextPageToken:
+                    print("Response %d: number of rows %d with next token %s" % (iReport, len(aRows), sNextPageToken))
+                else:
+                    print("Response %d: number of rows %d (no next page)" % (iReport, len(aRows)))
+
+            aReports.append({ 'rows': aAllRows, 'nextPageToken': sNextPageToken })
+
+        return aReports
 
     def outputRows (self, aRows):
-        """CSV output, optionally saving to a file"""
+        """CSV output of a list or iterator of rows, optionally saving to a file"""
 
-        # Use standard output or write to a file
-        if self.oCmdOptions.sOutputFile == None:
+        # Use standard output as is when interactive or without a file descriptor (e.g. redirected
+        # within Python), otherwise write through a single large binary buffer
+        iStdoutFileno = getFileno(sys.stdout)
+        if self.oCmdOptions.sOutputFile == None and (iStdoutFileno == None or sys.stdout.isatty()):
             fpOutput = sys.stdout
         else:
-            fpOutput = open(self.oCmdOptions.sOutputFile, 'w')
-
-        # Translate the header values unless skipping it altogether
-        if self.oCmdOptions.bSkipHeader:
-            aRows.pop(0)
-        elif not self.oCmdOptions.bSkipDimTranslate:
-            for n in range(0, len(aRows[0])):
-                sOriginal = aRows[0][n]
-                if sOriginal in self.CUSTOM_DIMENSIONS:
-                    sTranslate = self.CUSTOM_DIMENSIONS[aRows[0][n]]
-                    if self.oCmdOptions.bAddDimNames:
-                        aRows[0][n] = '%s (%s)' % (sTranslate, sOriginal)
-                    else:
-                        aRows[0][n] = sTranslate
-
-        # Get the CSV writer, using special options
-        if self.oCmdOptions.sDelimiter:
-            oFile = csv.writer(fpOutput, delimiter=self.oCmdOptions.sDelimiter)
+            if self.oCmdOptions.sOutputFile == None:
+                sys.stdout.flush()
+                oRawOutput = io.FileIO(iStdoutFileno, 'w', closefd=False)
+                sEncoding  = sys.stdout.encoding
+            else:
+                # Write to a temporary file, replacing the output file only once the download is complete
+                sTempFile  = '%s.%d.tmp' % (self.oCmdOptions.sOutputFile, os.getpid())
+                oRawOutput = io.FileIO(sTempFile, 'w')
+                sEncoding  = None
+            fpOutput = io.TextIOWrapper(io.BufferedWriter(oRawOutput, OUTPUT_BUFFER_SIZE),
+                                        encoding=sEncoding, newline='')
+
+        try:
+            # Get the CSV writer, using special options
+            if self.oCmdOptions.sDelimiter:
+                oFile = csv.writer(fpOutput, delimiter=self.oCmdOptions.sDelimiter)
+            else:
+                oFile = csv.writer(fpOutput)
+
+            # Translate the header values unless skipping it altogether
+            aRows   = iter(aRows)
+            aHeader = next(aRows, None)
+            iRows   = 0
+            if aHeader != None and not self.oCmdOptions.bSkipHeader:
+                if not self.oCmdOptions.bSkipDimTranslate:
+                    for n in range(0, len(aHeader)):
+                        sTranslate = self.CUSTOM_DIMENSIONS.get(aHeader[n])
+                        if sTranslate != None:
+                            if self.oCmdOptions.bAddDimNames:
+                                aHeader[n] = '%s (%s)' % (sTranslate, aHeader[n])
+                            else:
+                                aHeader[n] = sTranslate
+                oFile.writerow(aHeader)
+                iRows += 1
+
+            # Write all other rows as they arrive, counting them for the output file status message
+            def countRows (aRows):
+                nonlocal iRows
+                for aRow in aRows:
+                    iRows += 1
+                    yield aRow
+            if self.oCmdOptions.sOutputFile:
+                aRows = countRows(aRows)
+            oFile.writerows(aRows)
+
+        # Any error while downloading or writing the rows - never leave a partial output file
+        except BaseException:
+            if self.oCmdOptions.sOutputFile:
+                try:
+                    fpOutput.close()
+                finally:
+                    os.remove(sTempFile)
+            raise
+
+        # Flush all output, leaving standard output open
+        if fpOutput is sys.stdout:
+            fpOutput.flush()
         else:
-            oFile = csv.writer(fpOutput)
-
-        # Write all rows
-        for aRow in aRows:
-            oFile.writerow(aRow)
+            fpOutput.close()
 
-        # If writing to a file, close and provide a status message
+        # If writing to a file, move it into place and provide a status message
         if self.oCmdOptions.sOutputFile:
-            fpOutput.close()
-            print("Download complete, %d rows, output file: %s" % (len(aRows), self.oCmdOptions.sOutputFile))
+            os.replace(sTempFile, self.oCmdOptions.sOutputFile)
+            print("Download complete, %d rows, output file: %s" % (iRows, self.oCmdOptions.sOutputFile))
 
 
     def getStartDate (self, bReset = False):
         """Get the start date from the options, translating day referrals"""
 
-        if not hasattr(getStartDate, 'oStartDate') or bReset == True:
-            if re.search(r'^(today|yesterday|[0-9]+daysAgo)$', self.oCmdOptions.sStartDate):
-                if self.oCmdOptions.sStartDate == 'today':
+        if bReset == True or not hasattr(self, 'oStartDate'):
+            oMatch = REL_DATE_RE.match(self.oCmdOptions.sStartDate)
+            if oMatch:
+                if oMatch.group('relative') == 'today':
                     oStartDate = date.today()
-                elif self.oCmdOptions.sStartDate == 'yesterday':
+                elif oMatch.group('relative') == 'yesterday':
                     oStartDate = date.today() - timedelta(days=1)
                 else:
-                    oMatch = re.search(r'^([0-9]+)daysAgo', self.oCmdOptions.sStartDate)
-                    iDaysAgo = int(oMatch.group(1))
+                    iDaysAgo = int(oMatch.group('days'))
                     oStartDate = date.today() - timedelta(days=iDaysAgo)
             else:
-                oMatch = re.search(r'([0-9]{4})-([0-9]{2})-([0-9]{2})', self.oCmdOptions.sStartDate)
-                oStartDate = date(int(oMatch.group(1)), int(oMatch.group(2)), int(oMatch.group(3)))
-            getStartDate.oStartDate = oStartDate
-        return getStartDate.oStartDate
+                oMatch = DATE_RE.match(self.oCmdOptions.sStartDate)
+                oStartDate = date(int(oMatch.group('year')), int(oMatch.group('month')), int(oMatch.group('day')))
+            self.oStartDate = oStartDate
+        return self.oStartDate
+
+    def iterReport (self, aDimensions):
+        """Get a full report, yielding the rows as each page is downloaded"""
+        sPageToken = None
+        while True:
+            oReport   = self.getReport([ aDimensions ], [ sPageToken ])
+            oResponse = self.getResponse(oReport, sPageToken == None)[0]
+            yield from oResponse.get('rows')
+            sPageToken = oResponse.get('nextPageToken')
+            if sPageToken == None:
+                break
+
+    def processReports (self, aDimensionsList):
+        """Get a set of full reports, batching the requests, returning the rows of each report"""
+
+        # Build the shared service before the threads start, so an authorization failure stops only once
+        self.getAnalytics()
+
+        # Split into batches, each a single call, downloading the batches concurrently
+        aBatches = [ aDimensionsList[iStart:iStart + MAX_REPORT_REQUESTS]
+                     for iStart in range(0, len(aDimensionsList), MAX_REPORT_REQUESTS) ]
+        oExecutor = ThreadPoolExecutor(max_workers=min(self.MAX_CONCURRENT_REQUESTS, len(aBatches)))
+        try:
+            aFutures = [ oExecutor.submit(self.processReportBatch, aBatch) for aBatch in aBatches ]
+
+            # Wait for the batches as they complete, so that the first error is raised immediately
+            for oFuture in as_completed(aFutures):
+                oFuture.result()
+        except BaseException:
+            # On any error or interrupt, stop the running batches at their next page and
+            # drop the waiting ones, without waiting for them to finish
+            self.oStopEvent.set()
+            oExecutor.shutdown(wait=False, cancel_futures=True)
+            raise
+        oExecutor.shutdown()
+
+        # Rows of each report, in the order of the batches
+        return [ aRows for oFuture in aFutures for aRows in oFuture.result() ]
+
+    def processReportBatch (self, aBatchDimensions):
+        """Get a batch of full reports with a single call per page, returning the rows of each report"""
+
+        # Get the first set of each report in the batch
+        oReport   = self.getReport(aBatchDimensions)
+        aReports  = self.getResponse(oReport, True)
+        aRows     = [ oResponse.get('rows') for oResponse in aReports ]
+        dPending  = { n: oResponse.get('nextPageToken') for n, oResponse in enumerate(aReports)
+                      if oResponse.get('nextPageToken') != None }
+
+        # Add any additional sets, requesting only the reports with another page, until stopped
+        while dPending and not self.oStopEvent.is_set():
+            aPending = list(dPending)
+            oReport  = self.getReport([ aBatchDimensions[n] for n in aPending ],
+                                      [ dPending[n] for n in aPending ])
+            aReports = self.getResponse(oReport, False)
+            dPending = {}
+            for n, oResponse in zip(aPending, aReports):
+                aRows[n].extend(oResponse.get('rows'))
+                if oResponse.get('nextPageToken') != None:
+                    dPending[n] = oResponse.get('nextPageToken')
 
-    def processReport (self, aDimensions):
-        """Get a full report, returning the rows"""
+        return aRows
 
-        # Get the first set
-        oReport   = self.getReport(aDimensions)
-        oResponse = self.getResponse(oReport, True)
-        aRows     = oResponse.get('rows')
+    def addMiscDimensions (self, aResults, aBatchReports):
+        """Add the miscellaneous dimensions reports to the results"""
 
-        # Add any additional sets
-        while oResponse.get('nextPageToken') != None:
-            oResponse = self.getReport(aDimensions, oResponse.get('nextPageToken'))
-            oResponse = self.getResponse(oResponse, False)
-            aRows.extend(oResponse.get('rows'))
+        # Nothing to add without any batches
+        if not self.BATCH_DIMENSIONS:
+            return
 
-        return aRows
+        # Columns of the stitch elements within the results, found only once
+        aStitchDims = self.STITCH_DIMENSIONS
+        aResultDims = self.RESULTS_DIMENSIONS
+        sInvalid    = self.INVALID_VALUE
+        dResultIdx  = { dDimension['name']: i for i, dDimension in enumerate(aResultDims) }
+        aStitchIdx  = tuple(dResultIdx[dStitchDim['name']] for dStitchDim in aStitchDims)
+        iStitch     = len(aStitchDims)
 
-    def addMiscDimensions (self, aResults):
-        """Add the miscellaneous dimensions to the results"""
+        # Key getter for the stitch elements of the results, giving the same key as the batch
+        # rows (a tuple of the values, or the single value) for the same elements
+        fResultKey  = operator.itemgetter(*aStitchIdx)
 
-        # Loop over each miscellaneous dimension set
-        for aBatchDimSet in self.BATCH_DIMENSIONS:
+        # Loop over each miscellaneous dimension set with its report
+        for aBatchDimSet, aBatchResults in zip(self.BATCH_DIMENSIONS, aBatchReports):
 
             # Create an empty result set
-            aEmpty = []
-            for sField in aBatchDimSet:
-                aEmpty.append(self.INVALID_VALUE)
-
-            # Add the batch dimensions to the common "stitch" elements and get the report
-            aDimSet = self.STITCH_DIMENSIONS.copy()
-            aDimSet.extend(aBatchDimSet)
-            aBatchResults = self.processReport(aDimSet)
-
-            # Add the header to the results header, removing the stitch elements
-            aHeader = aBatchResults.pop(0)
-            for sStitchCol in self.STITCH_DIMENSIONS:
-                aHeader.pop(0)
-            aResults[0].extend(aHeader)
-
-            # Create dictionary with the stitch elements forming the key
-            aStitchElements = {}
-            for aRow in aBatchResults:
-                aKey = []
-                for sStitchCol in self.STITCH_DIMENSIONS:
-                    aKey.append("%s = %s" % (sStitchCol, aRow.pop(0)))
-                sKey = ' && '.join(aKey)
-                aStitchElements[sKey] = aRow
-
-            # Add the each row to the results, skipping the header row (n == 0)
-            for n in range(1, len(aResults)):
-
-                # Get this row
-                aRow = aResults[n]
-                
-                # Get the key using the stitch elements
-                aKey = []
-                for sStitchCol in self.STITCH_DIMENSIONS:
-                    iResultCol = self.RESULTS_DIMENSIONS.index(sStitchCol)
-                    aKey.append("%s = %s" % (sStitchCol, aRow[iResultCol]))
-                sKey = ' && '.join(aKey)
-
-                # Element exists - add to the results
-                if sKey in aStitchElements:
-                    aRow.extend(aStitchElements[sKey])
-                else:
-                    aRow.extend(aEmpty)
+            aEmpty = [ sInvalid ] * len(aBatchDimSet)
+
+            # Add the header to the results header, without the stitch elements
+            aResults[0].extend(aBatchResults[0][iStitch:])
+
+            # Create dictionary with the stitch elements forming the key, skipping the header row
+            aStitchElements = getStitchElements(aBatchResults, iStitch)
+
+            # Add the each row to the results, skipping the header row, with the
+            # element found using the stitch elements as the key or else the empty set
+            fGetStitch = aStitchElements.get
+            for aRow in itertools.islice(aResults, 1, None):
+                aRow.extend(fGetStitch(fResultKey(aRow), aEmpty))
 
 
     def combineReports (self, aUsers, aResults):
-        """Combine both reports into a single report"""
+        """Combine both reports into a single report, returned as an iterator of the rows"""
 
         # First column is common - throw out from results and combine to create the complete header 
-        aHeader        = aUsers.pop(0)
-        aHeaderResults = aResults.pop(0)
-        aHeaderResults.pop(0)
-        aHeader.extend(aHeaderResults)
+        aHeader = aUsers[0] + aResults[0][1:]
 
         # Get the name of the common column
         sCommonColumn = aHeader[0]
 
-        # Start the rows, adding the header
-        aAllRows = [ aHeader ]
-
-        # Get all users by the first column, which must be the same as the results
-        aUsersByCommonId = { }
-        for aRow in aUsers:
-            aUsersByCommonId[aRow[0]] = aRow
+        # Get all users by the first column, which must be the same as the results, skipping the header row
+        aUsersByCommonId = { aRow[0]: aRow for aRow in itertools.islice(aUsers, 1, None) }
 
-        # Go through each result, adding the user information
-        for aResult in aResults:
+        # Every result must have a user with the common ID (the first element) - this should never fail
+        aMissing = [ aResult[0] for aResult in itertools.islice(aResults, 1, None)
+                     if aResult[0] not in aUsersByCommonId ]
+        if aMissing:
+            errorMsg('results but no user found with %s values of %s' % (sCommonColumn, ', '.join(aMissing)))
 
-            # First element will be common with users
-            sCommonId = aResult.pop(0)
-
-            # User found with common ID - combine user and result information into a single row
-            if sCommonId in aUsersByCommonId:
-                aAllRows.append(aUsersByCommonId[sCommonId] + aResult)
-
-            # No user found with common ID - this should never happen
-            else:
-                errorMsg('result but no user found with %s value of %s' % (sCommonColumn, sCommonId))
-
-        return aAllRows
+        # Combine the user and result information of each result after the header into a single row,
+        # only as each row is written rather than holding another copy of all the results
+        return itertools.chain([ aHeader ], ( aUsersByCommonId[aResult[0]] + aResult[1:]
+                                              for aResult in itertools.islice(aResults, 1, None) ))
 
     def validDate (self, sDate):
         """Validate a date string"""
         if sDate == None:
             return False
-        return (re.search(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$', sDate) or
-                re.search(r'^(today|yesterday|[0-9]+daysAgo)$', sDate))
+        return bool(DATE_RE.match(sDate) or REL_DATE_RE.match(sDate))
 
     def downloadCombined (self):
         """Download the users and results, adding the miscellaneous dimensions"""
-        aUsers   = self.processReport(self.USER_DIMENSIONS)
-        aResults = self.processReport(self.RESULTS_DIMENSIONS)
-        self.addMiscDimensions(aResults)
-        self.outputRows(self.combineReports(aUsers, aResults))
-
-# Run the system
-oDownload = Download()
-oDownload.main()
-
 
+        # Add each set of batch dimensions to the common "stitch" elements
+        aBatchDimSets = [ self.STITCH_DIMENSIONS + aBatchDimSet for aBatchDimSet in self.BATCH_DIMENSIONS ]
 
+        # Get all the reports together, batching the requests
+        aUsers, aResults, *aBatchReports = self.processReports([ self.USER_DIMENSIONS, self.RESULTS_DIMENSIONS ] +
+                                                               aBatchDimSets)
+        self.addMiscDimensions(aResults, aBatchReports)
+        self.outputRows(self.combineReports(aUsers, aResults))
 
-            
+# Run the system, unless imported as a module
+if __name__ == '__main__':
+    oDownload = Download()
+    oDownload.main()